@@ -1,150 +1,230 @@
 import os
 import logging
+import random
 import time
 import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+
+# orjson serializes 3-5x faster and straight to bytes; fall back to stdlib json
+try:
+    import orjson
+
+    def json_dumps(payload):
+        return orjson.dumps(payload)
+except ImportError:
+    import json
+
+    def json_dumps(payload):
+        return json.dumps(payload).encode('utf-8')
 from google.cloud import bigquery
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from sendgrid.helpers.mail import Asm
+from google.cloud.bigquery import QueryJobConfig
+from google.cloud import bigquery_storage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
 
-# Initialize BigQuery Client
+# Initialize BigQuery clients (Storage Read API streams results as Arrow batches)
 bq_client = bigquery.Client()
+bqs_client = bigquery_storage.BigQueryReadClient()
+
+# Optional destination table for the aggregated result, e.g.
+# 'emporio-zingaro.z316_tiny.z316_loyalty_snapshot_23Q4'
+SNAPSHOT_TABLE = os.getenv('BQ_SNAPSHOT_TABLE')
 
-# SendGrid setup
+# Tables the aggregation query reads; the snapshot is stale once either changes
+SOURCE_TABLES = (
+    'emporio-zingaro.z316_tiny.z316-tiny-contatos',
+    'emporio-zingaro.z316_tiny.z316_commission_details_23Q4'
+)
+
+# SendGrid setup: one keep-alive session so all batches share pooled TLS connections
 SENDGRID_TOKEN = os.getenv('SENDGRID_TOKEN')
-sg_client = SendGridAPIClient(SENDGRID_TOKEN)
+SENDGRID_URL = 'https://api.sendgrid.com/v3/mail/send'
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+session.headers.update({
+    'Authorization': f'Bearer {SENDGRID_TOKEN}',
+    'Content-Type': 'application/json'
+})
 template_id = 'd-9c2512bde9eb49deb8e578bfcc0a1054'
 from_email = 'sac@emporiozingaro.com'
 
+# Envelope fields shared by every /mail/send request (incl. unsubscribe groups)
+base_payload = {
+    'from': {'email': from_email},
+    'template_id': template_id,
+    'asm': {
+        'group_id': 23817,
+        'groups_to_display': [23816, 23831, 23817]
+    }
+}
+
 # Test mode settings
 TEST_MODE = False
 TEST_EMAIL = 'rodrigo@brunale.com'
 EMAIL_SEND_LIMIT = 5
 
-# Adjusted query with test logic
+# SendGrid accepts up to 1000 personalizations per /mail/send request
+BATCH_SIZE = 1000
+MAX_WORKERS = 8
+MAX_SEND_ATTEMPTS = 4
+MAX_BACKOFF_SECONDS = 30
+
+# Aggregated per client so Python only formats one row per recipient
 query = """
-SELECT c.cpf_cnpj, c.email, cd.nome, cd.final_tier, cd.data_pedido, cd.pedido_number,
-       cd.nome_vendedor, cd.totalVenda, cd.cashback
+SELECT c.cpf_cnpj, c.email,
+       ANY_VALUE(cd.nome) AS nome,
+       ANY_VALUE(CASE cd.final_tier
+           WHEN 'Platinum' THEN 'Platina'
+           WHEN 'Gold' THEN 'Ouro'
+           WHEN 'Silver' THEN 'Prata'
+           ELSE cd.final_tier
+       END) AS final_tier,
+       SUM(cd.cashback) AS cashback_total,
+       SUM(cd.totalVenda) AS quarter_spend,
+       COUNT(DISTINCT DATE(cd.data_pedido)) AS daily_checkin_total,
+       ARRAY_AGG(STRUCT(cd.data_pedido, cd.pedido_number, cd.nome_vendedor, cd.totalVenda)
+                 ORDER BY cd.data_pedido, cd.pedido_number) AS purchase_details
 FROM `emporio-zingaro.z316_tiny.z316-tiny-contatos` as c
 JOIN `emporio-zingaro.z316_tiny.z316_commission_details_23Q4` as cd
 ON c.cpf_cnpj = cd.cpf
+WHERE c.email IS NOT NULL AND c.email != ''
+GROUP BY c.cpf_cnpj, c.email
 """
 
-def fetch_and_process_data():
+def snapshot_is_fresh():
     try:
-        query_job = bq_client.query(query)
-        results = query_job.result()
-
-        # Mapping for final_tier translation
-        final_tier_mapping = {
-            'Platinum': 'Platina',
-            'Bronze': 'Bronze',
-            'Silver': 'Prata',
-            'Gold': 'Ouro'
-        }
-
-        clients_data = {}
-        for row in results:
-            client_id = row['cpf_cnpj']
-            if client_id not in clients_data:
-                # Translate the final_tier value
-                translated_final_tier = final_tier_mapping.get(row['final_tier'], row['final_tier'])
-
-                clients_data[client_id] = {
+        snapshot = bq_client.get_table(SNAPSHOT_TABLE)
+    except Exception:
+        # No snapshot yet (e.g. first run); the query has to execute
+        return False
+    return all(bq_client.get_table(table_id).modified <= snapshot.modified
+               for table_id in SOURCE_TABLES)
+
+def fetch_clients():
+    try:
+        if SNAPSHOT_TABLE and snapshot_is_fresh():
+            # Sources unchanged since the last run: read the snapshot directly
+            logging.info(f"Snapshot table {SNAPSHOT_TABLE} is fresh; skipping the aggregation query.")
+            results = bq_client.list_rows(SNAPSHOT_TABLE)
+        else:
+            # Reruns against unchanged tables are served from BigQuery's result cache
+            job_config = QueryJobConfig(use_query_cache=True)
+            if SNAPSHOT_TABLE:
+                # Persist the aggregated result. A destination table disables the
+                # result cache, so the freshness check above covers reruns instead
+                job_config.destination = SNAPSHOT_TABLE
+                job_config.write_disposition = 'WRITE_TRUNCATE'
+            results = bq_client.query(query, job_config=job_config).result()
+
+        for record_batch in results.to_arrow_iterable(bqstorage_client=bqs_client):
+            for row in record_batch.to_pylist():
+                # Format the already-aggregated purchase details
+                purchase_details = [{
+                    'date': purchase['data_pedido'].strftime('%Y-%m-%d'),
+                    'order_number': purchase['pedido_number'],
+                    'seller': purchase['nome_vendedor'],
+                    'value': "{:.2f}".format(purchase['totalVenda'])
+                } for purchase in row['purchase_details']]
+
+                quarter_spend = "{:.2f}".format(row['quarter_spend'])
+
+                # Lazy %-formatting: nothing is built unless DEBUG is enabled
+                logging.debug("Final data for %s (%d purchases, quarter spend %s)",
+                              row['cpf_cnpj'], len(purchase_details), quarter_spend)
+
+                yield {
                     'client_name': row['nome'],
                     'email': row['email'],
-                    'purchase_details': [],
-                    'cashback_total': 0,
-                    'quarter_spend': 0,
-                    'daily_checkin_dates': set(),
-                    'final_tier': translated_final_tier
+                    'purchase_details': purchase_details,
+                    'daily_checkin_total': row['daily_checkin_total'],
+                    'quarter_spend': quarter_spend,
+                    'lifetime_spend': quarter_spend,
+                    'cashback': "{:.2f}".format(row['cashback_total']),
+                    'final_tier': row['final_tier']
                 }
 
-            formatted_date = row['data_pedido'].strftime('%Y-%m-%d')
-
-            # Add all purchase details
-            clients_data[client_id]['purchase_details'].append({
-                'date': formatted_date,
-                'order_number': row['pedido_number'],
-                'seller': row['nome_vendedor'],
-                'value': "{:.2f}".format(row['totalVenda'])
-            })
-
-            # Sum cashback and quarter spend
-            clients_data[client_id]['cashback_total'] += row['cashback']
-            clients_data[client_id]['quarter_spend'] += row['totalVenda']
-
-            # Check if this is the first purchase of the day for daily check-in
-            if formatted_date not in clients_data[client_id]['daily_checkin_dates']:
-                clients_data[client_id]['daily_checkin_dates'].add(formatted_date)
-
-        # Finalize data formatting
-        for client_id, data in clients_data.items():
-            data['daily_checkin_total'] = len(data['daily_checkin_dates'])
-            del data['daily_checkin_dates']  # Remove the set as it's no longer needed
-            data['quarter_spend'] = "{:.2f}".format(data['quarter_spend'])
-            data['lifetime_spend'] = data['quarter_spend']
-            data['cashback'] = "{:.2f}".format(data['cashback_total'])
-
-            logging.info(f"Final data for {client_id}: {data}")
-
-        return clients_data
-
     except Exception as e:
         logging.error(f"Error fetching or processing data: {e}")
-        return {}
 
-def send_email(client_data, retry_count=0):
-    try:
+def send_batch(clients_batch):
+    personalizations = []
+    for client_data in clients_batch:
         recipient_email = TEST_EMAIL if TEST_MODE else client_data.get('email')
         if not recipient_email:
             logging.warning(f"Email not sent. No email address for client {client_data['client_name']}.")
-            return
-
-        dynamic_template_data = {
-            'client_name': client_data['client_name'],
-            'cashback': client_data['cashback'],
-            'final_tier': client_data['final_tier'],
-            'purchase_details': client_data['purchase_details'],
-            'daily_checkin_total': client_data['daily_checkin_total'],
-            'quarter_spend': client_data['quarter_spend'],
-            'lifetime_spend': client_data['lifetime_spend']
-        }
-
-        message = Mail(from_email=from_email, to_emails=recipient_email)
-        message.template_id = template_id
-        message.dynamic_template_data = dynamic_template_data
-
-        # Set unsubscribe group information
-        asm = Asm(group_id=23817, groups_to_display=[23816, 23831, 23817])
-        message.asm = asm
-
-        response = sg_client.send(message)
-        if response.status_code not in range(200, 300):
-            raise Exception(f"Failed to send email: {response.status_code}")
-
-        logging.info(f"Email successfully sent to {recipient_email}")
-
-    except Exception as e:
-        logging.error(f"Error sending email to {recipient_email}: {e}")
-        if retry_count < 3:
-            time.sleep(2 ** retry_count)
-            send_email(client_data, retry_count + 1)
+            continue
+
+        # client_data is already shaped for the template; pass it through as-is
+        personalizations.append({
+            'to': [{'email': recipient_email}],
+            'dynamic_template_data': client_data
+        })
+
+    if not personalizations:
+        logging.warning("No deliverable recipients in this batch.")
+        return
+
+    recipients = len(personalizations)
+    # Shared envelope plus this batch's personalizations, serialized once;
+    # retries reuse the same encoded body
+    request_body = json_dumps(dict(base_payload, personalizations=personalizations))
+
+    delay = 0
+    for attempt in range(MAX_SEND_ATTEMPTS):
+        if delay:
+            time.sleep(delay)
+
+        retry_after = None
+        try:
+            response = session.post(SENDGRID_URL, data=request_body)
+            if response.status_code in range(200, 300):
+                logging.info(f"Batch of {recipients} emails successfully sent.")
+                return
+            if 400 <= response.status_code < 500 and response.status_code != 429:
+                # Client errors other than rate limiting won't succeed on retry
+                logging.error(f"Batch rejected with status {response.status_code}; not retrying.")
+                return
+            retry_after = response.headers.get('Retry-After')
+            logging.error(f"Failed to send batch: {response.status_code}")
+        except Exception as e:
+            logging.error(f"Error sending batch of {recipients} emails: {e}")
+
+        if retry_after is not None:
+            try:
+                delay = min(MAX_BACKOFF_SECONDS, float(retry_after))
+            except ValueError:
+                retry_after = None
+        if retry_after is None:
+            delay = min(MAX_BACKOFF_SECONDS, (2 ** attempt) + random.random())
+
+    logging.error(f"Giving up on batch of {recipients} emails after {MAX_SEND_ATTEMPTS} attempts.")
 
 def main():
-    clients_data = fetch_and_process_data()
+    batch = []
+    futures = []
     email_count = 0
 
-    for client_id, data in clients_data.items():
-        if TEST_MODE and email_count >= EMAIL_SEND_LIMIT:
-            logging.info("Email send limit reached in test mode.")
-            break
+    # Batches are dispatched as soon as they fill, while rows are still streaming in
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for client_data in fetch_clients():
+            if TEST_MODE and email_count >= EMAIL_SEND_LIMIT:
+                logging.info("Email send limit reached in test mode.")
+                break
+
+            batch.append(client_data)
+            email_count += 1
+            if len(batch) >= BATCH_SIZE:
+                futures.append(executor.submit(send_batch, batch))
+                batch = []
+
+        if batch:
+            futures.append(executor.submit(send_batch, batch))
 
-        send_email(data)
-        email_count += 1
+        for future in as_completed(futures):
+            future.result()
 
     logging.info("Email sending process completed.")
 